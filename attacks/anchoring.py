@@ -110,8 +110,9 @@ def _sample(
         raise NotImplementedError(f'Sampling method {sampling_method} not implemented.')
 
     # Calculate the masks for the two groups we will be sampling from
-    neg_adv_mask = torch.logical_and(dataset.adv_mask, ~dataset.Y.bool())
-    pos_disadv_mask = torch.logical_and(~dataset.adv_mask, dataset.Y.bool())
+    y_pos = dataset.Y.bool()
+    neg_adv_mask = dataset.adv_mask & ~y_pos
+    pos_disadv_mask = ~dataset.adv_mask & y_pos
 
     # Perform the assertions needed for type checking
     assert isinstance(neg_adv_mask, torch.BoolTensor)
@@ -113,8 +113,9 @@ def _sample(dataset: Dataset) -> Tuple[Tensor, Tensor]:
     Returns: a pair of (pos+adv, neg+disadv) samples
     """
     # Calculate the masks for (positive, advantaged) and (negative, disadvantaged) points
-    pos_adv_mask = torch.logical_and(dataset.Y.bool(), dataset.adv_mask)
-    neg_disadv_mask = torch.logical_and(~dataset.Y.bool(), ~dataset.adv_mask)
+    y_pos = dataset.Y.bool()
+    pos_adv_mask = y_pos & dataset.adv_mask
+    neg_disadv_mask = ~y_pos & ~dataset.adv_mask
 
     # Convert masks to indices
     pos_adv_indices = torch.where(pos_adv_mask)[0]
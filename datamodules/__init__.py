@@ -1,5 +1,5 @@
 from .compas import CompasDatamodule
-from .datamodule import Datamodule
+from .datamodule import Datamodule, GpuBatchIterator
 from .dataset import ConcatDataset, Dataset
 from .drug_consumption import DrugConsumptionDatamodule
 from .german_credit import GermanCreditDatamodule
@@ -1,16 +1,67 @@
 import os
+import tempfile
 from abc import abstractmethod, ABCMeta
-from typing import Optional, Tuple
+from typing import Iterator, Optional, Tuple, Union
 from urllib.request import urlretrieve
 
 import numpy as np
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
 
 from .dataset import ConcatDataset, Dataset
 
 
+class GpuBatchIterator:
+    def __init__(self, dataset: Dataset, batch_size: int, shuffle: bool = True, drop_last: bool = False,
+                 device: Union[str, torch.device] = 'cuda'):
+        """
+        Initialize an iterator over random batches of `dataset`, which is uploaded to `device` once, so that every
+        batch is sliced from device-resident tensors without any collating, pinning or host-to-device copies.
+
+        Args:
+            dataset: the dataset to iterate over
+            batch_size: the number of samples in each batch
+            shuffle: draw the batches from a new random permutation of the samples at every epoch
+            drop_last: drop the last batch if it is smaller than `batch_size`
+            device: the device to keep the dataset's tensors at
+        """
+        self.X = dataset.X.to(device)
+        self.Y = dataset.Y.to(device)
+        self.adv_mask = dataset.adv_mask.to(device)
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.IntTensor, torch.BoolTensor]]:
+        """
+        Iterate over the dataset's batches for one epoch.
+
+        Returns: an iterator of batches as tuples of (features, labels, adv_mask)
+        """
+        n = len(self.X)
+        if self.shuffle:
+            perm = torch.randperm(n, device=self.X.device)
+        else:
+            perm = torch.arange(n, device=self.X.device)
+
+        for i in range(0, len(self) * self.batch_size, self.batch_size):
+            idx = perm[i:i + self.batch_size]
+            yield self.X[idx], self.Y[idx], self.adv_mask[idx]
+
+    def __len__(self) -> int:
+        """
+        Get the number of batches in one epoch.
+
+        Returns: the number of batches
+        """
+        if self.drop_last:
+            return len(self.X) // self.batch_size
+
+        return (len(self.X) + self.batch_size - 1) // self.batch_size
+
+
 class Datamodule(pl.LightningDataModule, metaclass=ABCMeta):
     def __init__(self, file_name: str, data_dir: str, batch_size: int):
         """
@@ -39,13 +90,20 @@ class Datamodule(pl.LightningDataModule, metaclass=ABCMeta):
         """
         Prepares the data by downloading them if they do not exist locally
         """
-        if not os.path.exists(self.data_dir):
-            os.mkdir(self.data_dir)
-
-        urlretrieve(
-            url=f'https://raw.githubusercontent.com/Ninarehm/attack/master/Fairness_attack/data/{self.file_name}',
-            filename=self.path_to_file
-        )
+        os.makedirs(self.data_dir, exist_ok=True)
+
+        if not os.path.exists(self.path_to_file):
+            # Download to a temporary file first, so that an interrupted download never leaves a truncated dataset
+            # at the target path (which would then never be downloaded again)
+            url = f'https://raw.githubusercontent.com/Ninarehm/attack/master/Fairness_attack/data/{self.file_name}'
+            fd, tmp_path = tempfile.mkstemp(dir=self.data_dir, suffix='.part')
+            os.close(fd)
+            try:
+                urlretrieve(url=url, filename=tmp_path)
+                os.replace(tmp_path, self.path_to_file)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
 
     def setup(self, stage: Optional[str] = None) -> None:
         """
@@ -54,19 +112,32 @@ class Datamodule(pl.LightningDataModule, metaclass=ABCMeta):
         Args:
             stage: the stage during which this Datamodule is being setup (e.g. 'fit', 'test', 'None')
         """
-        # Load the NumPy array from the specified npz file
-        npz = np.load(self.path_to_file, allow_pickle=True)
+        # Load the NumPy array from the specified npz file, and extract X_train, X_test, Y_train, Y_test from it
+        # (npz archives cannot be memory-mapped and each access reads the array anew, so every array is read once,
+        # and the archive's file handle is closed right after)
+        with np.load(self.path_to_file, allow_pickle=True) as npz:
+            x_train_np, x_test_np = npz['X_train'], npz['X_test']
+            y_train_np, y_test_np = npz['Y_train'], npz['Y_test']
+
+        # Compute the advantaged masks on the raw NumPy features, with True values representing the points that
+        # are in the advantaged class, and False values the points that are in the disadvantaged
+        sensitive_idx = self.get_sensitive_index()
+        advantaged_value = self.get_advantaged_value()
+        adv_mask_train = torch.from_numpy(np.equal(x_train_np[:, sensitive_idx], advantaged_value))
+        adv_mask_test = torch.from_numpy(np.equal(x_test_np[:, sensitive_idx], advantaged_value))
 
-        # Extract X_train, X_test, Y_train, Y_test from the NumPy array
-        x_train, x_test = torch.tensor(npz['X_train']).float(), torch.tensor(npz['X_test']).float()
-        y_train, y_test = torch.tensor(npz['Y_train']).int(), torch.tensor(npz['Y_test']).int()
+        # Cast once on the NumPy side into contiguous float32/int32 buffers, which torch wraps without copying
+        x_train = torch.from_numpy(np.ascontiguousarray(x_train_np, dtype=np.float32))
+        x_test = torch.from_numpy(np.ascontiguousarray(x_test_np, dtype=np.float32))
+        y_train = torch.from_numpy(np.ascontiguousarray(y_train_np, dtype=np.int32))
+        y_test = torch.from_numpy(np.ascontiguousarray(y_test_np, dtype=np.int32))
 
         if stage in (None, 'fit'):
             # If we are in the training stage (or no stage), load the train dataset into memory
             self.train_data = Dataset(
                 X=x_train,
                 Y=y_train,
-                adv_mask=self.get_advantaged_mask(x_train)
+                adv_mask=adv_mask_train
             )
 
         if stage in (None, 'test'):
@@ -74,7 +145,7 @@ class Datamodule(pl.LightningDataModule, metaclass=ABCMeta):
             self.test_data = Dataset(
                 X=x_test,
                 Y=y_test,
-                adv_mask=self.get_advantaged_mask(x_test)
+                adv_mask=adv_mask_test
             )
 
     def get_input_size(self) -> Tuple:
@@ -121,28 +192,61 @@ class Datamodule(pl.LightningDataModule, metaclass=ABCMeta):
         """
         raise NotImplementedError()
 
-    def get_advantaged_mask(self, features: torch.Tensor) -> torch.BoolTensor:
+    def _is_distributed(self) -> bool:
         """
-        Get this dataset's advantaged mask, with the True values representing the points that
-        are in the advantaged class, and False values the points that are in the disadvantaged.
+        Check whether the attached Trainer (if any) runs on multiple processes, in which case Lightning has to shard
+        the DataLoaders by replacing their samplers with a DistributedSampler.
 
-        Args:
-            features: the features (X) of the dataset
+        Returns: whether training/testing is distributed
+        """
+        return self.trainer is not None and self.trainer.world_size > 1
 
-        Returns: the dataset's advantaged binary mask
+    def _get_trainer_device(self) -> Optional[torch.device]:
         """
-        sensitive_idx = self.get_sensitive_index()
-        advantaged_value = self.get_advantaged_value()
+        Get the device that the attached Trainer (if any) runs on.
+
+        Returns: the Trainer's root device, or None if no Trainer is attached
+        """
+        return self.trainer.strategy.root_device if self.trainer is not None else None
 
-        return features[:, sensitive_idx] == advantaged_value
+    def _dataloader_kwargs(self, persistent_workers: bool) -> dict:
+        """
+        Get the keyword arguments shared by this Datamodule's DataLoaders, i.e. a few worker processes with
+        prefetching, and pinned memory (when the Trainer runs on a GPU) so host-to-device copies can be asynchronous.
+        The DataLoaders are given a BatchSampler and no batch size, so that each batch is gathered by indexing the
+        dataset once with all of its indices, instead of collating the samples one by one.
+
+        Args:
+            persistent_workers: keep the worker processes alive across epochs
 
-    def train_dataloader(self) -> DataLoader:
+        Returns: the DataLoader keyword arguments
         """
-        Get the Datamodule's train DataLoader.
+        device = self._get_trainer_device()
+        return dict(
+            num_workers=min(4, max(1, (os.cpu_count() or 2) // 2)),
+            pin_memory=device is not None and device.type == 'cuda',
+            persistent_workers=persistent_workers,
+            prefetch_factor=2
+        )
+
+    def train_dataloader(self) -> Union[DataLoader, GpuBatchIterator]:
+        """
+        Get the Datamodule's train DataLoader. If the Trainer runs on a GPU, the (small) train dataset is instead kept
+        resident on it, and batches are sliced there directly.
 
         Returns: the train dataloader
         """
-        return DataLoader(self.train_data, self.batch_size, shuffle=True, drop_last=True, num_workers=4)
+        kwargs = self._dataloader_kwargs(persistent_workers=True)
+        if self._is_distributed():
+            # A regular DataLoader, so that Lightning can shard it across processes with a DistributedSampler
+            return DataLoader(self.train_data, self.batch_size, shuffle=True, drop_last=True, **kwargs)
+
+        device = self._get_trainer_device()
+        if device is not None and device.type == 'cuda':
+            return GpuBatchIterator(self.train_data, self.batch_size, shuffle=True, drop_last=True, device=device)
+
+        sampler = BatchSampler(RandomSampler(self.train_data), self.batch_size, drop_last=True)
+        return DataLoader(self.train_data, batch_size=None, sampler=sampler, **kwargs)
 
     def test_dataloader(self) -> DataLoader:
         """
@@ -150,7 +254,13 @@ class Datamodule(pl.LightningDataModule, metaclass=ABCMeta):
 
         Returns: the test dataloader
         """
-        return DataLoader(self.test_data, self.batch_size, num_workers=4)
+        kwargs = self._dataloader_kwargs(persistent_workers=False)
+        if self._is_distributed():
+            # A regular DataLoader, so that Lightning can shard it across processes with a DistributedSampler
+            return DataLoader(self.test_data, self.batch_size, **kwargs)
+
+        sampler = BatchSampler(SequentialSampler(self.test_data), self.batch_size, drop_last=False)
+        return DataLoader(self.test_data, batch_size=None, sampler=sampler, **kwargs)
 
     def get_train_dataset(self) -> Dataset:
         """
@@ -23,12 +23,16 @@ class Dataset(TorchDataset):
         self.Y = Y
         self.adv_mask = adv_mask
 
-    def __getitem__(self, idx: Union[int, Tensor]) -> Tuple[Tensor, IntTensor, BoolTensor]:
+        # Advantaged/disadvantaged row indices, lazily built by `_get_group_indices` for the mask they came from
+        self._group_idx = None
+        self._group_idx_mask = None
+
+    def __getitem__(self, idx: Union[int, Tensor, List[int]]) -> Tuple[Tensor, IntTensor, BoolTensor]:
         """
-        Get a sample from this dataset at the specified index.
+        Get a sample (or a batch of samples, if given multiple indices) from this dataset at the specified index.
 
         Args:
-            idx: the sample's index
+            idx: the sample's index, or the batch's indices
 
         Returns: a sample as a tuple of (features, label, adv_mask)
         """
@@ -53,13 +57,36 @@ class Dataset(TorchDataset):
         
         return x.squeeze(0), y.squeeze(0), adv_mask.squeeze(0)
 
+    def _get_group_indices(self) -> Tuple[Tensor, Tensor]:
+        """
+        Get the row indices (int32 suffices) of the advantaged and disadvantaged samples, so that subsets are gathered
+        with index_select. They are computed on first use, and recomputed only if `adv_mask` is reassigned.
+
+        Returns: a tuple of (advantaged indices, disadvantaged indices)
+        """
+        if self._group_idx is None or self._group_idx_mask is not self.adv_mask:
+            # The mask may also be a NumPy array (e.g. for datasets returned by the defense), which is wrapped
+            adv_mask = torch.as_tensor(self.adv_mask)
+            self._group_idx = (
+                adv_mask.nonzero(as_tuple=True)[0].to(torch.int32),
+                (~adv_mask).nonzero(as_tuple=True)[0].to(torch.int32)
+            )
+            self._group_idx_mask = self.adv_mask
+
+        return self._group_idx
+
     def get_advantaged_subset(self) -> Dataset:
         """
         Get the advantaged subset of this dataset.
 
         Returns: the advantaged subset
         """
-        return Dataset(self.X[self.adv_mask], self.Y[self.adv_mask], self.adv_mask[self.adv_mask])
+        adv_idx, _ = self._get_group_indices()
+        return Dataset(
+            torch.as_tensor(self.X).index_select(0, adv_idx),
+            torch.as_tensor(self.Y).index_select(0, adv_idx),
+            torch.as_tensor(self.adv_mask).new_ones(len(adv_idx))
+        )
     
     def get_disadvantaged_subset(self) -> Dataset:
         """
@@ -67,7 +94,12 @@ class Dataset(TorchDataset):
 
         Returns: the disadvantaged subset
         """
-        return Dataset(self.X[~self.adv_mask], self.Y[~self.adv_mask], self.adv_mask[~self.adv_mask])
+        _, dis_idx = self._get_group_indices()
+        return Dataset(
+            torch.as_tensor(self.X).index_select(0, dis_idx),
+            torch.as_tensor(self.Y).index_select(0, dis_idx),
+            torch.as_tensor(self.adv_mask).new_zeros(len(dis_idx))
+        )
 
     def get_positive_count(self) -> int:
         """
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import torch
 from torch import nn
 
@@ -18,10 +20,10 @@ class SPD(Metric):
         """
         super().__init__(dist_sync_on_step=dist_sync_on_step)
 
-        self.add_state("preds_adv_pos", default=torch.tensor(0), dist_reduce_fx="sum")
-        self.add_state("preds_dis_pos", default=torch.tensor(0), dist_reduce_fx="sum")
-        self.add_state("num_adv", default=torch.tensor(0), dist_reduce_fx="sum")
-        self.add_state("num_dis", default=torch.tensor(0), dist_reduce_fx="sum")
+        self.add_state("preds_adv_pos", default=torch.zeros((), dtype=torch.long), dist_reduce_fx="sum")
+        self.add_state("preds_dis_pos", default=torch.zeros((), dtype=torch.long), dist_reduce_fx="sum")
+        self.add_state("num_adv", default=torch.zeros((), dtype=torch.long), dist_reduce_fx="sum")
+        self.add_state("num_dis", default=torch.zeros((), dtype=torch.long), dist_reduce_fx="sum")
 
         self.use_abs = use_abs
 
@@ -34,17 +36,20 @@ class SPD(Metric):
             adv_mask: advantage mask
         """
 
-        # Advantaged and disadvantaged predictions
-        preds_adv = preds[adv_mask]
-        preds_dis = preds[~adv_mask]
+        # Encode each point as 2 * advantaged + positive, and count all four (group, prediction) buckets in one pass:
+        # [disadvantaged & negative, disadvantaged & positive, advantaged & negative, advantaged & positive]
+        # (index_add_ into a fixed-size output, as torch.bincount syncs with the host to size its output on CUDA)
+        adv_mask = adv_mask.to(preds.device, non_blocking=True)
+        key = adv_mask.long() * 2 + preds.eq(1).long()
+        counts = torch.zeros(4, dtype=torch.long, device=preds.device).index_add_(0, key, torch.ones_like(key))
 
         # Update the number of advantaged and disadvantaged points predicted as positive
-        self.preds_adv_pos += len(preds_adv[preds_adv == 1])
-        self.preds_dis_pos += len(preds_dis[preds_dis == 1])
+        self.preds_adv_pos += counts[3]
+        self.preds_dis_pos += counts[1]
 
         # Update the number of advantaged and disadvantaged points
-        self.num_adv += len(preds_adv)
-        self.num_dis += len(preds_dis)
+        self.num_adv += counts[2] + counts[3]
+        self.num_dis += counts[0] + counts[1]
 
     def compute(self):
         """
@@ -54,17 +59,17 @@ class SPD(Metric):
         """
 
         # Probability that the model predicts as positive a data point that has advantage
-        p_adv = self.preds_adv_pos / max(self.num_adv, 1)
+        p_adv = self.preds_adv_pos / self.num_adv.clamp_min(1)
 
         # Probability that the model predicts as positive a data point that has disadvantage
-        p_dis = self.preds_dis_pos / max(self.num_dis, 1)
+        p_dis = self.preds_dis_pos / self.num_dis.clamp_min(1)
 
         # Calculate SPD
         spd = p_adv - p_dis
         if self.use_abs:
-            spd = abs(spd)
+            spd = torch.abs(spd)
 
-        return spd.item()
+        return spd
 
 
 class EOD(Metric):
@@ -83,10 +88,10 @@ class EOD(Metric):
         """
         super().__init__(dist_sync_on_step=dist_sync_on_step)
 
-        self.add_state("preds_adv_pos", default=torch.tensor(0), dist_reduce_fx="sum")
-        self.add_state("preds_dis_pos", default=torch.tensor(0), dist_reduce_fx="sum")
-        self.add_state("num_adv", default=torch.tensor(0), dist_reduce_fx="sum")
-        self.add_state("num_dis", default=torch.tensor(0), dist_reduce_fx="sum")
+        self.add_state("preds_adv_pos", default=torch.zeros((), dtype=torch.long), dist_reduce_fx="sum")
+        self.add_state("preds_dis_pos", default=torch.zeros((), dtype=torch.long), dist_reduce_fx="sum")
+        self.add_state("num_adv", default=torch.zeros((), dtype=torch.long), dist_reduce_fx="sum")
+        self.add_state("num_dis", default=torch.zeros((), dtype=torch.long), dist_reduce_fx="sum")
 
         self.use_abs = use_abs
 
@@ -100,17 +105,21 @@ class EOD(Metric):
             adv_mask: advantage mask
         """
 
-        # Advantaged and disadvantaged predictions with label +1
-        preds_adv = preds[torch.logical_and(adv_mask, targets.bool())]
-        preds_dis = preds[torch.logical_and(~adv_mask, targets.bool())]
+        # Advantaged and disadvantaged masks with label +1, and positive predictions, each computed once
+        # (on the predictions' device, so the reductions accumulate into the states without crossing devices)
+        adv_mask = adv_mask.to(preds.device, non_blocking=True)
+        tbool = targets.to(preds.device, non_blocking=True).bool()
+        adv_t = adv_mask & tbool
+        dis_t = ~adv_mask & tbool
+        pos = preds.eq(1)
 
         # Update the number of advantaged and disadvantaged points with label +1 predicted as positive
-        self.preds_adv_pos += len(preds_adv[preds_adv == 1])
-        self.preds_dis_pos += len(preds_dis[preds_dis == 1])
+        self.preds_adv_pos += (pos & adv_t).sum()
+        self.preds_dis_pos += (pos & dis_t).sum()
 
         # Update the number of advantaged and disadvantaged points with target +1
-        self.num_adv += torch.logical_and(adv_mask, (targets.bool())).sum()
-        self.num_dis += torch.logical_and(~adv_mask, (targets.bool())).sum()
+        self.num_adv += adv_t.sum()
+        self.num_dis += dis_t.sum()
 
     def compute(self):
         """
@@ -120,17 +129,17 @@ class EOD(Metric):
         """
 
         # Probability that the model predicts as positive a data point that has advantage and label +1
-        p_adv = self.preds_adv_pos / max(self.num_adv, 1)
+        p_adv = self.preds_adv_pos / self.num_adv.clamp_min(1)
 
         # Probability that the model predicts as positive a data point that has disadvantage and label +1
-        p_dis = self.preds_dis_pos / max(self.num_dis, 1)
+        p_dis = self.preds_dis_pos / self.num_dis.clamp_min(1)
 
         # Calculate the EOD
         eod = p_adv - p_dis
         if self.use_abs:
-            eod = abs(eod)
+            eod = torch.abs(eod)
 
-        return eod.item()
+        return eod
 
 
 class FairnessLoss(nn.Module):
@@ -141,17 +150,43 @@ class FairnessLoss(nn.Module):
     by linear models.
     """
     
-    def __init__(self, sensitive_attribute_idx: int):
+    def __init__(self, sensitive_attribute_idx: int, X_fixed: Optional[Tensor] = None):
         super().__init__()
         
         self.sensitive_attribute_idx = sensitive_attribute_idx
+
+        # Centered sensitive attribute of a fixed dataset, reused by every forward pass over that same dataset
+        # (plain attributes rather than a buffer, so that both stay on the cached dataset's device together)
+        self._cached_X = None
+        self._cached_zc = None
+        if X_fixed is not None:
+            self.set_cache(X_fixed)
+
+    def set_cache(self, X: Tensor):
+        """
+        Precompute the centered sensitive attribute (z - z_bar) of a dataset that the loss will be repeatedly
+        evaluated on. The cache is only used when `forward` receives this exact tensor (and no gradients w.r.t. it
+        are needed), so it must not be modified in place afterwards.
+
+        Args:
+            X: the features of the dataset
+        """
+        z = X[:, self.sensitive_attribute_idx]
+        self._cached_X = X
+        self._cached_zc = z - z.mean()
         
     def forward(self, X: Tensor, W: Tensor, b: Tensor):
         # Assert we have linear model for binary classification
         assert W.ndim == 2 and b.shape == torch.Size([1])
         
-        # Get sensitive attribute from data
-        z = X[:, self.sensitive_attribute_idx]
+        if X is self._cached_X and not X.requires_grad:
+            # Reuse the centered sensitive attribute of the cached dataset
+            zc = self._cached_zc
+        else:
+            # Get sensitive attribute from data
+            z = X[:, self.sensitive_attribute_idx]
+            zc = z - z.mean()
         
-        # Vectorized version of 1/N Σ[(z_i - z_bar) * θ.T * x_i]
-        return torch.mean((z - z.mean()) * (X @ W.flatten() + b))
+        # Vectorized version of 1/N Σ[(z_i - z_bar) * θ.T * x_i], as a fused matvec (with the bias) and a single dot
+        pred = torch.addmv(b, X, W.flatten())
+        return torch.dot(zc, pred) / X.shape[0]
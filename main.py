@@ -35,7 +35,9 @@ def create_poisoned_dataset(
     Returns: the poisoned dataset
     """
     if args.attack in ['IAF', 'Koh', 'Solans']:
-        bce_loss, fairness_loss = BCEWithLogitsLoss(), FairnessLoss(dm.get_sensitive_index())
+        # The fairness loss is repeatedly evaluated on the (fixed) test set, so cache its sensitive attribute
+        bce_loss = BCEWithLogitsLoss()
+        fairness_loss = FairnessLoss(dm.get_sensitive_index(), X_fixed=dm.get_test_dataset().X)
 
         if args.attack == 'IAF':
             # Create adversarial loss according to Mehrabi et al.
@@ -95,6 +97,8 @@ def main(args: argparse.Namespace):
         args: the arguments passed to the program
     """
     pl.seed_everything(123)
+    # Allow TF32 matmuls on Ampere+ GPUs (no effect on CPU or older GPUs)
+    torch.backends.cuda.matmul.allow_tf32 = True
     test_results = []
     for run in range(args.num_runs):
         # Set up the Datamodule based on the dataset name
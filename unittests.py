@@ -1,6 +1,8 @@
 import abc
 import unittest
 
+import numpy as np
+
 import pytorch_lightning as pl
 import torch
 from scipy.spatial.distance import cdist as compute_distances
@@ -8,8 +10,8 @@ from torch import Tensor, IntTensor, BoolTensor
 from torch.nn import BCEWithLogitsLoss
 
 from attacks import anchoring, influence
-from datamodules import GermanCreditDatamodule
-from fairness import FairnessLoss
+from datamodules import Dataset, GermanCreditDatamodule, GpuBatchIterator
+from fairness import EOD, SPD, FairnessLoss
 from trainingmodule import BinaryClassifier
 
 
@@ -263,6 +265,208 @@ class InfluenceTest(AttackTest):
         self.assertEqual(num_params, num_weights + num_biases)
 
 
+class FairnessMetricsTest(unittest.TestCase):
+    @staticmethod
+    def reference_rate_difference(preds: Tensor, group_mask: BoolTensor, dis_mask: BoolTensor) -> float:
+        """
+        Reference computation of the (signed) difference of positive prediction rates between two groups, using
+        boolean-indexed gathers, with empty groups having a rate of 0.
+
+        Args:
+            preds: the predictions
+            group_mask: the binary mask of the first (advantaged) group
+            dis_mask: the binary mask of the second (disadvantaged) group
+
+        Returns: the difference of the positive prediction rates
+        """
+        preds_adv, preds_dis = preds[group_mask], preds[dis_mask]
+        p_adv = len(preds_adv[preds_adv == 1]) / max(len(preds_adv), 1)
+        p_dis = len(preds_dis[preds_dis == 1]) / max(len(preds_dis), 1)
+        return p_adv - p_dis
+
+    def assert_metrics(self, preds: IntTensor, targets: IntTensor, adv_mask: BoolTensor):
+        """
+        Assert that SPD and EOD (with and without the absolute value) match the reference gather-based formulas.
+
+        Args:
+            preds: the predictions
+            targets: the ground truth labels
+            adv_mask: the advantaged mask
+        """
+        y_pos = targets.bool()
+        spd = self.reference_rate_difference(preds, adv_mask, ~adv_mask)
+        eod = self.reference_rate_difference(preds, adv_mask & y_pos, ~adv_mask & y_pos)
+
+        for use_abs in (True, False):
+            expected_spd, expected_eod = (abs(spd), abs(eod)) if use_abs else (spd, eod)
+            self.assertAlmostEqual(SPD(use_abs=use_abs)(preds, adv_mask).item(), expected_spd, places=6)
+            self.assertAlmostEqual(EOD(use_abs=use_abs)(preds, targets, adv_mask).item(), expected_eod, places=6)
+
+    def test_mixed_groups(self):
+        """
+        Test the metrics on random predictions, labels and groups.
+        """
+        for _ in range(10):
+            preds = torch.randint(0, 2, (50,)).int()
+            targets = torch.randint(0, 2, (50,)).int()
+            adv_mask = torch.rand(50) > 0.5
+            self.assert_metrics(preds, targets, adv_mask)
+
+    def test_empty_group(self):
+        """
+        Test the metrics when one of the groups is empty, so the denominators are clamped.
+        """
+        preds = torch.tensor([1, 0, 1, 1], dtype=torch.int)
+        targets = torch.tensor([1, 1, 0, 1], dtype=torch.int)
+        for adv_mask in (torch.ones(4, dtype=torch.bool), torch.zeros(4, dtype=torch.bool)):
+            self.assert_metrics(preds, targets, adv_mask)
+
+    def test_known_values(self):
+        """
+        Test the metrics on a hand-computed example, where the advantaged group has the lower rates.
+        """
+        preds = torch.tensor([1, 0, 0, 1, 1, 0], dtype=torch.int)
+        targets = torch.tensor([1, 1, 0, 1, 1, 0], dtype=torch.int)
+        adv_mask = torch.tensor([1, 1, 1, 0, 0, 0], dtype=torch.bool)
+
+        # SPD = 1/3 - 2/3, EOD = 1/2 - 2/2
+        self.assertAlmostEqual(SPD(use_abs=False)(preds, adv_mask).item(), -1 / 3, places=6)
+        self.assertAlmostEqual(SPD(use_abs=True)(preds, adv_mask).item(), 1 / 3, places=6)
+        self.assertAlmostEqual(EOD(use_abs=False)(preds, targets, adv_mask).item(), -1 / 2, places=6)
+        self.assertAlmostEqual(EOD(use_abs=True)(preds, targets, adv_mask).item(), 1 / 2, places=6)
+
+
+class FairnessLossTest(unittest.TestCase):
+    def setUp(self):
+        """
+        Set up the fairness loss test with random features and linear model parameters.
+        """
+        self.sensitive_idx = 2
+        self.X = torch.randn(37, 6)
+        self.W = torch.randn(1, 6)
+        self.b = torch.randn(1)
+
+    def test_cached_matches_uncached(self):
+        """
+        Test that the loss computed with the cached sensitive attribute equals the uncached one.
+        """
+        uncached = FairnessLoss(self.sensitive_idx)(self.X, self.W, self.b)
+        cached = FairnessLoss(self.sensitive_idx, X_fixed=self.X)(self.X, self.W, self.b)
+        self.assertTrue(torch.allclose(cached, uncached))
+
+    def test_requires_grad_bypasses_cache(self):
+        """
+        Test that inputs requiring gradients do not use the cache, so the gradients w.r.t. them are correct.
+        """
+        X = self.X.clone().requires_grad_(True)
+        loss = FairnessLoss(self.sensitive_idx, X_fixed=X)
+
+        # Poison the cache, so that using it would produce a different value
+        loss._cached_zc = torch.zeros(len(X))
+
+        expected = FairnessLoss(self.sensitive_idx)(X, self.W, self.b)
+        actual = loss(X, self.W, self.b)
+        self.assertTrue(torch.allclose(actual, expected))
+
+        # The gradients w.r.t. the input also flow through the sensitive attribute
+        expected_grad, = torch.autograd.grad(expected, X)
+        actual_grad, = torch.autograd.grad(actual, X)
+        self.assertTrue(torch.allclose(actual_grad, expected_grad))
+
+
+class DatasetTest(unittest.TestCase):
+    def setUp(self):
+        """
+        Set up the dataset test with small random features, labels and advantaged mask.
+        """
+        self.X = torch.randn(11, 3)
+        self.Y = torch.randint(0, 2, (11,)).int()
+        self.adv_mask = torch.tensor([1, 0, 0, 1, 1, 0, 1, 0, 1, 1, 0], dtype=torch.bool)
+
+    def assert_subsets(self, dataset: Dataset):
+        """
+        Assert that the advantaged and disadvantaged subsets of `dataset` contain exactly the rows of each group.
+
+        Args:
+            dataset: the dataset to get the subsets of
+        """
+        for subset, mask, is_advantaged in (
+            (dataset.get_advantaged_subset(), self.adv_mask, True),
+            (dataset.get_disadvantaged_subset(), ~self.adv_mask, False)
+        ):
+            self.assertTrue(torch.equal(torch.as_tensor(subset.X), self.X[mask]))
+            self.assertTrue(torch.equal(torch.as_tensor(subset.Y), self.Y[mask]))
+            self.assertTrue(torch.all(torch.as_tensor(subset.adv_mask) == is_advantaged))
+            self.assertEqual(len(subset), mask.sum().item())
+
+    def test_subsets(self):
+        """
+        Test the advantaged and disadvantaged subsets of a tensor-backed dataset.
+        """
+        self.assert_subsets(Dataset(self.X, self.Y, self.adv_mask))
+
+    def test_subsets_numpy(self):
+        """
+        Test the advantaged and disadvantaged subsets of a NumPy-backed dataset, like the ones returned by the defense.
+        """
+        self.assert_subsets(Dataset(self.X.numpy(), self.Y.numpy(), self.adv_mask.numpy()))
+
+    def test_subsets_after_mask_reassignment(self):
+        """
+        Test that the subsets follow the advantaged mask when it is reassigned after they were first computed.
+        """
+        dataset = Dataset(self.X, self.Y, ~self.adv_mask)
+        dataset.get_advantaged_subset()
+
+        dataset.adv_mask = self.adv_mask
+        self.assert_subsets(dataset)
+
+
+class GpuBatchIteratorTest(unittest.TestCase):
+    def setUp(self):
+        """
+        Set up the iterator test with a small random dataset, whose size is not a multiple of the batch size.
+        """
+        self.batch_size = 5
+        self.dataset = Dataset(torch.randn(23, 4), torch.randint(0, 2, (23,)).int(), torch.rand(23) > 0.5)
+
+    def test_num_batches(self):
+        """
+        Test the number of batches per epoch, with and without dropping the last (incomplete) batch.
+        """
+        for drop_last, expected in ((True, 4), (False, 5)):
+            iterator = GpuBatchIterator(self.dataset, self.batch_size, drop_last=drop_last, device='cpu')
+            self.assertEqual(len(iterator), expected)
+            self.assertEqual(len(list(iterator)), expected)
+
+    def test_epoch_covers_dataset(self):
+        """
+        Test that a shuffled epoch (without dropping the last batch) yields every sample exactly once.
+        """
+        iterator = GpuBatchIterator(self.dataset, self.batch_size, shuffle=True, device='cpu')
+        X = torch.cat([x for x, _, _ in iterator])
+
+        # Every yielded row matches exactly one dataset row, and every dataset row is yielded exactly once
+        matches = torch.all(X.unsqueeze(1) == self.dataset.X.unsqueeze(0), dim=2)
+        self.assertTrue(torch.all(matches.sum(dim=0) == 1))
+        self.assertTrue(torch.all(matches.sum(dim=1) == 1))
+
+    def test_fit(self):
+        """
+        Test that a model can be trained on the iterator's batches.
+        """
+        model = BinaryClassifier('LogisticRegression', (4,))
+        trainer = pl.Trainer(
+            max_epochs=1,
+            logger=False,
+            enable_checkpointing=False,
+            enable_model_summary=False,
+            enable_progress_bar=False
+        )
+        trainer.fit(model, GpuBatchIterator(self.dataset, self.batch_size, device='cpu'))
+        self.assertEqual(trainer.current_epoch, 1)
+
+
 if __name__ == '__main__':
     pl.seed_everything(123)
     unittest.main()